@@ -8,13 +8,17 @@ Requires the OPENAI_API_KEY environment variable to be set before launch.
 
 from __future__ import annotations
 
+import asyncio
 import os
 import tkinter as tk
 from tkinter import messagebox, scrolledtext
 import threading
+from collections import deque
+
+import httpx
 
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI
 except ImportError as exc:  # pragma: no cover - helpful startup message
     raise SystemExit(
         "The OpenAI Python client is required. Install it with 'pip install openai'."
@@ -27,17 +31,55 @@ except Exception:  # pragma: no cover
 
 try:
     # Optional: semantic retrieval via Supabase
-    from supabase.retriever import retrieve_context, format_context_for_prompt
+    from supabase.retriever import aretrieve_context, format_context_for_prompt
 except Exception:
-    retrieve_context = None  # type: ignore
+    aretrieve_context = None  # type: ignore
     format_context_for_prompt = None  # type: ignore
 
 MODEL_NAME = "gpt-4o-mini"
+# Shared, never-mutated system prompt: the same object heads every request so its
+# serialized bytes (and the provider's cached prefix) are identical across turns
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a helpful assistant. Keep replies concise and stay on topic.",
+}
+# Number of most recent user/assistant pairs kept in history (system prompt is kept separately)
+MAX_TURNS = 20
+# Extra messages tolerated past the window before trimming, so the oldest messages
+# are dropped in chunks and the request prefix stays byte-identical between trims
+TRIM_BUFFER = 8
+# Conversations longer than this many messages bypass retrieval caches: the lookup
+# rarely hits once context has built up and risks false-positive cached answers.
+# Overridable with SA_CACHE_MAX_HISTORY (read once .env is loaded)
+CONVERSATION_HISTORY_THRESHOLD = 15
+# Compact role codes stored in history instead of role strings
+ROLE_USER = 1
+ROLE_ASSISTANT = 2
+_ROLE_NAMES = ("system", "user", "assistant")
+# Per-request timeout (seconds) so a stalled call cannot hold the UI forever
+REQUEST_TIMEOUT = 60.0
+# Streamed text is flushed to the Text widget at most once per frame (~60 Hz)
+DRAIN_INTERVAL_MS = 16
+# Minimum spacing between scroll-to-end layout passes on the transcript
+SCROLL_THROTTLE_MS = 50
+
+
+def _history_threshold() -> int:
+    """Return SA_CACHE_MAX_HISTORY, or the default when unset or not an integer."""
+    try:
+        return int(os.getenv("SA_CACHE_MAX_HISTORY", CONVERSATION_HISTORY_THRESHOLD))
+    except ValueError:
+        return CONVERSATION_HISTORY_THRESHOLD
 
 
 class ContextChatApp:
     """Tkinter UI that maintains a running context with the OpenAI Responses API."""
 
+    # Tk constants bound once on the class; read per streamed chunk in the hot paths
+    _END = tk.END
+    _NORMAL = tk.NORMAL
+    _DISABLED = tk.DISABLED
+
     def __init__(self, master: tk.Tk) -> None:
         self.master = master
         master.title("OpenAI Context Window")
@@ -45,46 +87,93 @@ class ContextChatApp:
         # Load .env if available
         if load_dotenv is not None:
             load_dotenv(override=False)
-
-        self.client = OpenAI()
-        self.history: list[dict[str, str]] = [
-            {
-                "role": "system",
-                "content": (
-                    "You are a helpful assistant. Keep replies concise and stay on topic."
-                ),
-            }
-        ]
+        self._cache_max_history = _history_threshold()
+
+        # Requests run as coroutines on one long-lived event loop thread instead of a
+        # fresh thread per send; results are posted back to Tk via ``master.after``
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+
+        # One pooled HTTP client for the whole session so turns reuse warm TLS connections
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=4, max_connections=8),
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=5.0),
+            http2=True,
+        )
+        self.client = AsyncOpenAI(http_client=self._http)
+        # Conversation turns as (role code, content) tuples; SYSTEM_MESSAGE is kept
+        # out of the deque so trimming can pop from the left in O(1)
+        self.history: deque[tuple[int, str]] = deque(maxlen=2 * MAX_TURNS + TRIM_BUFFER + 1)
+        # Server-side conversation state: the Responses API chains turns by id, so
+        # only the new user message needs to be sent on each request.
+        self._last_response_id: str | None = None
 
         self._build_widgets()
-        # Typing placeholder simple state (no animation)
-        self._typing_present: bool = False
         # Prevent concurrent sends (Enter + Button, double taps)
         self._inflight: bool = False
-        # Keep fallback indices for typing placeholder
-        self._typing_start_str: str | None = None
-        self._typing_end_str: str | None = None
+        # In-flight request task; only touched on the event loop thread
+        self._request: asyncio.Task[str] | None = None
+        # Whether streamed text for the current reply has started rendering
+        self._stream_started: bool = False
+        # Streamed text waiting to be drained onto the Text widget by the UI thread
+        self._pending: deque[str] = deque()
+        self._drain_scheduled: bool = False
+        # Scroll throttling: a see() ran recently / more text arrived meanwhile
+        self._see_pending: bool = False
+        self._see_dirty: bool = False
+        # Set once the window is closing; the loop thread must no longer touch Tk
+        self._closing: bool = False
+
+        master.protocol("WM_DELETE_WINDOW", self._on_close)
+
+    def _on_close(self) -> None:
+        """Close the window and hand connection cleanup to the event loop.
+
+        The Tk thread must not wait on the loop here: callbacks on the loop thread
+        that call into Tk would block on the Tk thread in turn.
+        """
+        self._closing = True
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+        self.master.destroy()
+
+    async def _shutdown(self) -> None:
+        """Cancel the in-flight request, close the HTTP pool and stop the loop."""
+        try:
+            request = self._request
+            if request is not None:
+                request.cancel()
+                await asyncio.gather(request, return_exceptions=True)
+            await self._http.aclose()
+        finally:
+            self._loop.stop()
 
     def _build_widgets(self) -> None:
         """Create the minimal UI controls."""
 
-        self.chat_display = scrolledtext.ScrolledText(self.master, wrap=tk.WORD, height=20)
+        # Read-only transcript: no undo stack, so inserts skip separator bookkeeping
+        self.chat_display = scrolledtext.ScrolledText(
+            self.master, wrap=tk.WORD, height=20, undo=False, autoseparators=False
+        )
         self.chat_display.configure(state=tk.DISABLED)
-        self.chat_display.grid(row=0, column=0, columnspan=2, padx=10, pady=10, sticky="nsew")
-        # Tag for typing placeholder styling
-        self.chat_display.tag_configure("typing_tag", foreground="gray")
+        self.chat_display.grid(row=0, column=0, columnspan=3, padx=10, pady=10, sticky="nsew")
 
         self.input_entry = tk.Entry(self.master, width=80)
         self.input_entry.grid(row=1, column=0, padx=(10, 0), pady=(0, 10), sticky="ew")
         self.input_entry.bind("<Return>", self._on_send)
 
         self.send_button = tk.Button(self.master, text="Send", command=self._on_send)
-        self.send_button.grid(row=1, column=1, padx=(5, 10), pady=(0, 10), sticky="e")
+        self.send_button.grid(row=1, column=1, padx=(5, 0), pady=(0, 10), sticky="e")
+
+        self.cancel_button = tk.Button(
+            self.master, text="Cancel", command=self._on_cancel, state=tk.DISABLED
+        )
+        self.cancel_button.grid(row=1, column=2, padx=(5, 10), pady=(0, 10), sticky="e")
 
         # Status label to indicate loading / typing state
         self.status_var = tk.StringVar(value="")
         self.status_label = tk.Label(self.master, textvariable=self.status_var, fg="gray")
-        self.status_label.grid(row=2, column=0, columnspan=2, padx=10, pady=(0, 10), sticky="w")
+        self.status_label.grid(row=2, column=0, columnspan=3, padx=10, pady=(0, 10), sticky="w")
 
         self.master.rowconfigure(0, weight=1)
         self.master.columnconfigure(0, weight=1)
@@ -103,212 +192,266 @@ class ContextChatApp:
         self.input_entry.delete(0, tk.END)
         # Show the user's message immediately in the chat window
         self._append_message("You", user_text)
-        self.history.append({"role": "user", "content": user_text})
+        self._record(ROLE_USER, user_text)
 
-        # Enter loading state and fetch response on a background thread
+        # Enter loading state and fetch response on the event loop thread
+        # Replies are streamed, so the first delta doubles as the typing indicator
         self._set_loading(True, message="Assistant is typing...")
-        self._insert_typing_placeholder()
         self._inflight = True
-        thread = threading.Thread(target=self._fetch_response, daemon=True)
-        thread.start()
+        self._loop.call_soon_threadsafe(self._start_request)
         return "break" if event is not None else None
 
-    def _fetch_response(self) -> None:
-        """Background worker to query the model and dispatch UI updates back on the main thread."""
-        try:
-            response_text = self._query_model()
-        except Exception as error:  # pragma: no cover - user feedback only
-            # Schedule error handling on the Tkinter main loop
-            self.master.after(0, lambda: self._on_response_error(error))
+    def _on_cancel(self) -> None:
+        """Abandon the in-flight request at its next await point."""
+        if self._inflight:
+            self._loop.call_soon_threadsafe(self._cancel_request)
+            self.status_var.set("Cancelling...")
+
+    def _start_request(self) -> None:
+        """Schedule the model query as a task (runs on the event loop thread)."""
+        if self._closing:
             return
+        self._request = self._loop.create_task(self._query_model())
+        self._request.add_done_callback(self._fetch_response)
+
+    def _cancel_request(self) -> None:
+        """Cancel the in-flight task, if any (runs on the event loop thread)."""
+        if self._request is not None:
+            self._request.cancel()
+
+    def _fetch_response(self, task: asyncio.Task[str]) -> None:
+        """Dispatch the finished request's outcome back to the Tkinter main loop."""
+        self._request = None
+        if self._closing:
+            # The window is gone (or going); there is nothing left to update
+            return
+        if task.cancelled():
+            # The stream, if any, was closed by its context manager
+            self.master.after(0, self._on_response_cancelled)
+        elif task.exception() is not None:  # pragma: no cover - user feedback only
+            error = task.exception()
+            self.master.after(0, lambda: self._on_response_error(error))
+        else:
+            response_text = task.result()
+            self.master.after(0, lambda: self._on_response_ready(response_text))
+        # Always release the UI, whatever happened to the request
+        self.master.after(0, self._finish_request)
 
-        # Schedule UI update on the Tkinter main loop
-        self.master.after(0, lambda: self._on_response_ready(response_text))
+    def _finish_request(self) -> None:
+        """Leave the loading state once the worker is done."""
+        self._set_loading(False)
+        self._inflight = False
 
     def _on_response_ready(self, response_text: str) -> None:
         """Handle successful model response on the UI thread."""
         # First, record in history
-        self.history.append({"role": "assistant", "content": response_text})
-        # Prefer replacing the typing placeholder in place; fall back to append
-        replaced = self._replace_typing_with_response(response_text)
-        if not replaced:
+        self._record(ROLE_ASSISTANT, response_text)
+        if self._stream_started or self._pending:
+            # Text is (mostly) on screen; flush the rest and close off the message
+            self._end_stream()
+        else:
+            # Nothing was streamed (empty reply)
             self._append_message("Assistant", response_text)
-        self._set_loading(False)
-        self._inflight = False
+
+    def _on_response_cancelled(self) -> None:
+        """Close off whatever was rendered for a cancelled reply."""
+        if self._stream_started or self._pending:
+            self._end_stream()
+
+    def _enqueue_delta(self, text: str) -> None:
+        """Queue streamed text from the event loop thread and schedule a single drain."""
+        self._pending.append(text)
+        if not self._drain_scheduled and not self._closing:
+            self._drain_scheduled = True
+            self.master.after(DRAIN_INTERVAL_MS, self._drain)
+
+    def _drain(self, tail: str = "") -> None:
+        """Flush all queued streamed text (plus ``tail``) in one widget insert."""
+        # Clear the flag before draining so text queued meanwhile schedules a new drain
+        self._drain_scheduled = False
+        parts: list[str] = []
+        while self._pending:
+            parts.append(self._pending.popleft())
+        if tail:
+            parts.append(tail)
+        if parts:
+            self._append_delta("".join(parts))
+
+    def _append_delta(self, text: str) -> None:
+        """Append a chunk of streamed reply text at the assistant cursor."""
+        self.chat_display.configure(state=self._NORMAL)
+        if not self._stream_started:
+            # First chunk starts the message; the header goes in the same insert
+            self.chat_display.mark_set("assistant_cursor", "end-1c")
+            self.chat_display.mark_gravity("assistant_cursor", tk.RIGHT)
+            text = "Assistant: " + text
+            self._stream_started = True
+        self.chat_display.insert("assistant_cursor", text)
+        self.chat_display.configure(state=self._DISABLED)
+        self._scroll_to_end()
+
+    def _scroll_to_end(self) -> None:
+        """Keep the newest text visible with at most one ``see`` per throttle window."""
+        if self._see_pending:
+            # Picked up by the trailing call once the window closes
+            self._see_dirty = True
+            return
+        # Skip the layout pass when the end of the transcript is already in view
+        if self.chat_display.yview()[1] < 0.999:
+            self.chat_display.see(self._END)
+        self._see_pending = True
+        self.master.after(SCROLL_THROTTLE_MS, self._release_scroll)
+
+    def _release_scroll(self) -> None:
+        """Close the throttle window, scrolling once more if text arrived during it."""
+        self._see_pending = False
+        if self._see_dirty:
+            self._see_dirty = False
+            self._scroll_to_end()
+
+    def _end_stream(self) -> None:
+        """Flush remaining streamed text, terminate the message and drop its cursor mark."""
+        self._drain(tail="\n\n")
+        self.chat_display.mark_unset("assistant_cursor")
+        self._stream_started = False
+
+    def _record(self, role: int, content: str) -> None:
+        """Append a turn to the history and apply the sliding window."""
+        self.history.append((role, content))
+        self._trim_history()
+
+    def _trim_history(self) -> None:
+        """Keep the system prompt plus the last ``MAX_TURNS`` user/assistant pairs.
+
+        Trimming only fires once ``TRIM_BUFFER`` extra messages have accumulated,
+        so the cacheable prefix shifts once per chunk rather than on every turn.
+        """
+        if len(self.history) > 2 * MAX_TURNS + TRIM_BUFFER:
+            for _ in range(len(self.history) - 2 * MAX_TURNS):
+                self.history.popleft()
+
+    def _to_messages(self) -> list[dict[str, str]]:
+        """Materialize SDK-shaped messages (system prompt first) from the history."""
+        messages = [SYSTEM_MESSAGE]
+        messages.extend(
+            {"role": _ROLE_NAMES[role], "content": content} for role, content in self.history
+        )
+        return messages
 
     def _on_response_error(self, error: Exception) -> None:  # pragma: no cover - user feedback only
         """Handle an error from the background request on the UI thread."""
         messagebox.showerror("OpenAI Error", str(error))
-        self._remove_typing_placeholder()
-        self._set_loading(False)
-        self._inflight = False
+        if self._stream_started or self._pending:
+            self._end_stream()
 
     def _set_loading(self, is_loading: bool, message: str | None = None) -> None:
         """Enable or disable UI loading state and optional status message."""
         if is_loading:
             self.input_entry.configure(state=tk.DISABLED)
             self.send_button.configure(state=tk.DISABLED)
+            self.cancel_button.configure(state=tk.NORMAL)
             if message is not None:
                 self.status_var.set(message)
         else:
             self.input_entry.configure(state=tk.NORMAL)
             self.send_button.configure(state=tk.NORMAL)
+            self.cancel_button.configure(state=tk.DISABLED)
             self.status_var.set("")
 
-    def _insert_typing_placeholder(self) -> None:
-        """Insert a single, static typing line if not already present."""
-        if self._typing_present:
-            return
-        self.chat_display.configure(state=tk.NORMAL)
-        # Clean previous marks and tagged regions
-        try:
-            self.chat_display.mark_unset("typing_start")
-            self.chat_display.mark_unset("typing_end")
-        except Exception:
-            pass
-        try:
-            ranges = self.chat_display.tag_ranges("typing_tag")
-            if len(ranges) >= 2:
-                self.chat_display.delete(ranges[0], ranges[1])
-                self.chat_display.tag_remove("typing_tag", "1.0", tk.END)
-        except Exception:
-            pass
-        # Insert placeholder and set marks tightly around it
-        start_index = self.chat_display.index(tk.END)
-        self._typing_start_str = start_index
-        self.chat_display.mark_set("typing_start", start_index)
-        self.chat_display.mark_gravity("typing_start", tk.LEFT)
-        placeholder = "Assistant: typing...\n\n"
-        self.chat_display.insert("typing_start", placeholder)
-        self.chat_display.mark_set("typing_end", f"typing_start+{len(placeholder)}c")
-        self.chat_display.mark_gravity("typing_end", tk.RIGHT)
-        self._typing_end_str = self.chat_display.index("typing_end")
-        self.chat_display.tag_add("typing_tag", "typing_start", "typing_end")
-        self.chat_display.configure(state=tk.DISABLED)
-        self.chat_display.see(tk.END)
-        self._typing_present = True
-
-    def _remove_typing_placeholder(self) -> None:
-        """Remove the static typing line if present."""
-        if not self._typing_present:
-            return
-        self.chat_display.configure(state=tk.NORMAL)
+    async def _retrieval_message(
+        self, query: str, use_cache: bool = True
+    ) -> dict[str, str] | None:
+        """Build a system message with Supabase units context for ``query`` (best-effort)."""
         try:
-            self.chat_display.delete("typing_start", "typing_end")
-            self.chat_display.tag_remove("typing_tag", "1.0", tk.END)
-            try:
-                self.chat_display.mark_unset("typing_start")
-                self.chat_display.mark_unset("typing_end")
-            except Exception:
-                pass
+            if query and aretrieve_context and format_context_for_prompt:
+                matches = await aretrieve_context(
+                    query, k=8, min_similarity=0.0, use_cache=use_cache
+                )
+                context_text = format_context_for_prompt(matches)
+                if context_text:
+                    return {
+                        "role": "system",
+                        "content": (
+                            "Use the following units data as factual context when answering. "
+                            "If relevant, cite unit fields (bloco/unidade/tipologia/row_id).\n\n"
+                            + context_text
+                        ),
+                    }
         except Exception:
+            # Silently ignore retrieval errors; fall back to normal chat
             pass
-        self.chat_display.configure(state=tk.DISABLED)
-        self._typing_present = False
-        self._typing_start_str = None
-        self._typing_end_str = None
+        return None
 
-    def _replace_typing_with_response(self, response_text: str) -> bool:
-        """Replace the typing placeholder with the assistant's response in place.
+    async def _query_model(self) -> str:
+        """Send the latest user turn to the model and return the reply.
 
-        Returns True if replacement occurred; otherwise False (no placeholder found).
+        With the Responses API only the new user message is sent; earlier turns are
+        referenced through ``previous_response_id`` instead of being re-uploaded. The
+        reply is streamed, and text deltas are forwarded to the UI as they arrive.
         """
-        try:
-            text = f"Assistant: {response_text}\n\n"
-            self.chat_display.configure(state=tk.NORMAL)
-            # 1) Try marks first
-            try:
-                self.chat_display.delete("typing_start", "typing_end")
-                self.chat_display.insert("typing_start", text)
-                replaced = True
-            except Exception:
-                replaced = False
-            # 2) Fallback to stored indices
-            if not replaced and self._typing_start_str and self._typing_end_str:
-                try:
-                    self.chat_display.delete(self._typing_start_str, self._typing_end_str)
-                    self.chat_display.insert(self._typing_start_str, text)
-                    replaced = True
-                except Exception:
-                    replaced = False
-            # 3) Fallback to search in text
-            if not replaced:
-                try:
-                    start_found = self.chat_display.search("Assistant: typing...", "1.0", tk.END)
-                    if start_found:
-                        end_found = self.chat_display.index(f"{start_found}+{len('Assistant: typing...\n\n')}c")
-                        self.chat_display.delete(start_found, end_found)
-                        self.chat_display.insert(start_found, text)
-                        replaced = True
-                except Exception:
-                    replaced = False
-
-            # Clear tag and marks if we replaced
-            if replaced:
-                self.chat_display.tag_remove("typing_tag", "1.0", tk.END)
-                try:
-                    self.chat_display.mark_unset("typing_start")
-                    self.chat_display.mark_unset("typing_end")
-                except Exception:
-                    pass
-                self._typing_present = False
-                self._typing_start_str = None
-                self._typing_end_str = None
-            self.chat_display.configure(state=tk.DISABLED)
-            self.chat_display.see(tk.END)
-            return replaced
-        except Exception:
-            pass
-        return False
-
-    def _query_model(self) -> str:
-        """Send the conversation history to the model and return the reply."""
 
-        messages = [{"role": msg["role"], "content": msg["content"]} for msg in self.history]
-
-        # Retrieval-augmented context from Supabase (best-effort)
-        try:
-            last_user = None
-            for m in reversed(self.history):
-                if m.get("role") == "user":
-                    last_user = m.get("content")
-                    break
-            if last_user and retrieve_context and format_context_for_prompt:
-                matches = retrieve_context(last_user, k=8, min_similarity=0.0)
-                context_text = format_context_for_prompt(matches)
-                if context_text:
-                    messages.insert(
-                        1,
-                        {
-                            "role": "system",
-                            "content": (
-                                "Use the following units data as factual context when answering. "
-                                "If relevant, cite unit fields (bloco/unidade/tipologia/row_id).\n\n"
-                                + context_text
-                            ),
-                        },
-                    )
-        except Exception:
-            # Silently ignore retrieval errors; fall back to normal chat
-            pass
+        last_user = None
+        for role, content in reversed(self.history):
+            if role == ROLE_USER:
+                last_user = content
+                break
+        # +1 counts the system prompt, as in the SDK message list
+        use_cache = len(self.history) + 1 <= self._cache_max_history
+        context_message = await self._retrieval_message(last_user or "", use_cache=use_cache)
 
+        client = self.client.with_options(timeout=REQUEST_TIMEOUT)
         if hasattr(self.client, "responses"):
-            response = self.client.responses.create(model=MODEL_NAME, input=messages)
+            turn_input: list[dict[str, str]] = []
+            if self._last_response_id is None:
+                # Sent once: as an input item the system prompt is stored with the
+                # conversation, whereas ``instructions`` is not carried across turns
+                turn_input.append(SYSTEM_MESSAGE)
+            turn_input.append({"role": "user", "content": last_user or ""})
+            extra: dict[str, str] = {}
+            if context_message is not None:
+                # Per-turn context goes in ``instructions`` precisely because it is not
+                # stored: later turns only ever see their own, fresh retrieval results
+                extra["instructions"] = context_message["content"]
+            async with client.responses.stream(
+                model=MODEL_NAME,
+                input=turn_input,
+                previous_response_id=self._last_response_id,
+                store=True,
+                # Drop the oldest stored turns instead of failing once the chain
+                # outgrows the context window (the fallback path trims its deque)
+                truncation="auto",
+                **extra,
+            ) as stream:
+                async for event in stream:
+                    if event.type == "response.output_text.delta":
+                        self._enqueue_delta(event.delta)
+                response = await stream.get_final_response()
+            self._last_response_id = response.id
             return response.output_text.strip()
 
-        # Fallback for older OpenAI Python SDK versions (<1.0)
-        completion = self.client.chat.completions.create(model=MODEL_NAME, messages=messages)
-        message = completion.choices[0].message
-        # "message" can be either a dict (legacy) or an object with a ``content`` attribute.
-        if isinstance(message, dict):
-            return (message.get("content") or "").strip()
-        return (getattr(message, "content", "") or "").strip()
+        # Fallback for SDK versions without the Responses API; only this path needs
+        # the full message list, so dicts are built here and nowhere else
+        messages = self._to_messages()
+        if context_message is not None:
+            # Place per-turn context at the tail so the cached prefix is left untouched
+            messages.insert(len(messages) - 1, context_message)
+        stream = await client.chat.completions.create(
+            model=MODEL_NAME, messages=messages, stream=True
+        )
+        parts: list[str] = []
+        async with stream:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta if chunk.choices else None
+                if delta and delta.content:
+                    parts.append(delta.content)
+                    self._enqueue_delta(delta.content)
+        return "".join(parts).strip()
 
     def _append_message(self, speaker: str, text: str) -> None:
-        self.chat_display.configure(state=tk.NORMAL)
-        self.chat_display.insert(tk.END, f"{speaker}: {text}\n\n")
-        self.chat_display.configure(state=tk.DISABLED)
-        self.chat_display.see(tk.END)
+        self.chat_display.configure(state=self._NORMAL)
+        self.chat_display.insert(self._END, f"{speaker}: {text}\n\n")
+        self.chat_display.configure(state=self._DISABLED)
+        self._scroll_to_end()
 
 
 def main() -> None:
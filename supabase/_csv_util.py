@@ -0,0 +1,19 @@
+"""CSV helpers shared by the units scripts."""
+
+from __future__ import annotations
+
+import unicodedata
+from typing import Iterable, Optional
+
+
+def find_price_key(headers: Iterable[str]) -> Optional[str]:
+    """Return the header of the price ('preço') column, or None if there is none.
+
+    Headers are folded to lower-case ASCII, so 'Preço', 'preco' and mojibake
+    variants such as 'pre��o' (the undecodable bytes drop out) all match.
+    """
+    for h in headers:
+        folded = unicodedata.normalize("NFKD", h or "").encode("ascii", "ignore").decode()
+        if folded.strip().lower().startswith("pre"):
+            return h
+    return None
@@ -1,12 +1,19 @@
 from __future__ import annotations
 
+import argparse
+import asyncio
 import csv
-import json
+import gzip
 import os
+import sqlite3
+from hashlib import blake2b
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
-import requests
+import httpx
+import numpy as np
+import orjson
+import tiktoken
 
 try:
     from dotenv import load_dotenv  # type: ignore
@@ -14,17 +21,45 @@ except Exception:  # pragma: no cover
     load_dotenv = None
 
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI
 except ImportError as exc:  # pragma: no cover
     raise SystemExit(
         "The OpenAI Python client is required. Install it with 'pip install openai'."
     ) from exc
 
 
+try:
+    from ._csv_util import find_price_key
+except ImportError:  # run as a script from supabase/
+    from _csv_util import find_price_key
+
+
 BASE_DIR = Path(__file__).resolve().parent
 CSV_PATH = BASE_DIR / "units_rows.csv"
+CACHE_PATH = BASE_DIR / "_embed_cache.db"
 EMBED_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
 
+# Embed requests are packed by token count; the API accepts up to 300k tokens and
+# 2048 inputs per request, so stay comfortably below the former
+MAX_EMBED_TOKENS = 200_000
+MAX_EMBED_ROWS = 2048
+
+# Rows per PostgREST upsert; the cost is per request, not per row
+UPSERT_BATCH = 1024
+# Transient Supabase responses retried by the upsert workers
+UPSERT_RETRY_STATUSES = frozenset({429, 502, 503})
+UPSERT_RETRIES = 3
+UPSERT_BACKOFF = 0.5  # seconds, doubled per attempt
+
+# OpenAI Batch API limits and polling schedule (jobs complete within 24h)
+BATCH_MAX_REQUESTS = 50_000
+BATCH_POLL_INITIAL = 30.0
+BATCH_POLL_MAX = 300.0
+BATCH_TERMINAL = ("completed", "failed", "expired", "cancelled")
+
+# End-of-stream marker passed between pipeline stages
+_DONE = object()
+
 
 def _ensure_env_loaded() -> None:
     if load_dotenv is not None:
@@ -44,75 +79,178 @@ def _sb_headers() -> Dict[str, str]:
     }
 
 
-def _openai() -> OpenAI:
-    return OpenAI()
+def _openai() -> AsyncOpenAI:
+    return AsyncOpenAI()
 
 
-def _build_content(row: Dict[str, str]) -> str:
-    # Normalize likely column names, tolerant to mojibake on 'preço'
-    def norm_ascii(s: str) -> str:
-        return "".join(ch for ch in (s or "").lower() if "a" <= ch <= "z")
+def _tokenizer() -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(EMBED_MODEL)
+    except KeyError:
+        # Unknown (e.g. newer) model names; the text-embedding-3 models use cl100k
+        return tiktoken.get_encoding("cl100k_base")
 
-    price_key = None
-    for k in row.keys():
-        nk = norm_ascii(k)
-        if nk.startswith("preco") or nk.startswith("pre"):
-            price_key = k
-            break
 
-    parts: List[str] = []
-    unidade = (row.get("unidade") or "").strip()
-    tipologia = (row.get("tipologia") or "").strip()
-    bloco = (row.get("bloco") or "").strip()
-    piso = (row.get("piso") or "").strip()
-    ahb = (row.get("AHB") or "").strip()
-    abe = (row.get("ABE") or "").strip()
-    preco = (row.get(price_key) or "").strip() if price_key else ""
-    luz = (row.get("luz_natural") or "").strip()
-    score = (row.get("score") or "").strip()
-
-    if unidade:
-        parts.append(f"Unidade {unidade}")
-    if bloco:
-        parts.append(f"Bloco {bloco}")
-    if tipologia:
-        parts.append(f"Tipologia {tipologia}")
-    if piso:
-        parts.append(f"Piso {piso}")
-    if ahb:
-        parts.append(f"AHB {ahb}")
-    if abe:
-        parts.append(f"ABE {abe}")
-    if preco:
-        parts.append(f"Preço {preco}")
-    if luz:
-        parts.append(f"Luz Natural {luz}")
-    if score:
-        parts.append(f"Score {score}")
+def _open_cache(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS emb(key TEXT PRIMARY KEY, vec BLOB)")
+    return conn
 
+
+def _cache_key(text: str) -> str:
+    # Keyed by model + content so changing either forces a fresh embedding
+    return blake2b(f"{EMBED_MODEL}|{text}".encode("utf-8")).hexdigest()
+
+
+def _cache_get(conn: sqlite3.Connection, keys: List[str]) -> Dict[str, np.ndarray]:
+    found: Dict[str, np.ndarray] = {}
+    # Stay well below SQLite's bound-parameter limit
+    for start in range(0, len(keys), 500):
+        part = keys[start : start + 500]
+        marks = ",".join("?" * len(part))
+        for key, vec in conn.execute(f"SELECT key, vec FROM emb WHERE key IN ({marks})", part):
+            found[key] = np.frombuffer(vec, dtype=np.float32)
+    return found
+
+
+def _cache_put(conn: sqlite3.Connection, items: Iterable[Tuple[str, np.ndarray]]) -> None:
+    # float32 bytes are ~4x smaller than the JSON float representation
+    conn.executemany(
+        "INSERT OR REPLACE INTO emb(key, vec) VALUES (?, ?)",
+        ((key, vec.tobytes()) for key, vec in items),
+    )
+    conn.commit()
+
+
+async def _run_embedding_batch(client: AsyncOpenAI, texts: Dict[str, str]) -> Dict[str, np.ndarray]:
+    """Embed ``texts`` (cache key -> text) through one OpenAI Batch API job."""
+    lines = [
+        orjson.dumps(
+            {
+                "custom_id": key,
+                "method": "POST",
+                "url": "/v1/embeddings",
+                "body": {"model": EMBED_MODEL, "input": text},
+            }
+        )
+        for key, text in texts.items()
+    ]
+    upload = await client.files.create(
+        file=("embeddings.jsonl", b"\n".join(lines)), purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=upload.id, endpoint="/v1/embeddings", completion_window="24h"
+    )
+
+    delay = BATCH_POLL_INITIAL
+    while batch.status not in BATCH_TERMINAL:
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX)
+        batch = await client.batches.retrieve(batch.id)
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Embedding batch {batch.id} ended with status {batch.status}")
+
+    output = await client.files.content(batch.output_file_id)
+    vectors: Dict[str, np.ndarray] = {}
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        item = orjson.loads(line)
+        resp = item.get("response") or {}
+        if item.get("error") or resp.get("status_code") != 200:
+            raise RuntimeError(f"Embedding failed for {item.get('custom_id')}: {item.get('error')}")
+        embedding = resp["body"]["data"][0]["embedding"]
+        vectors[item["custom_id"]] = np.asarray(embedding, dtype=np.float32)
+    missing = texts.keys() - vectors.keys()
+    if missing:
+        raise RuntimeError(f"Embedding batch {batch.id} is missing {len(missing)} results")
+    return vectors
+
+
+def _encode_upsert(records: List[Dict[str, Any]], compress: bool) -> bytes:
+    # orjson encodes the float32 vectors natively (and far faster than json)
+    body = orjson.dumps(records, option=orjson.OPT_SERIALIZE_NUMPY)
+    return gzip.compress(body, compresslevel=6) if compress else body
+
+
+# (column, label) pairs in the order they appear in the embedded text; the price
+# column is resolved per CSV (see find_price_key) and marked with None here
+CONTENT_FIELDS: Tuple[Tuple[Optional[str], str], ...] = (
+    ("unidade", "Unidade"),
+    ("bloco", "Bloco"),
+    ("tipologia", "Tipologia"),
+    ("piso", "Piso"),
+    ("AHB", "AHB"),
+    ("ABE", "ABE"),
+    (None, "Preço"),
+    ("luz_natural", "Luz Natural"),
+    ("score", "Score"),
+)
+
+META_KEYS: Tuple[str, ...] = (
+    "id",
+    "unidade",
+    "tipologia",
+    "bloco",
+    "piso",
+    "AHB",
+    "ABE",
+    "luz_natural",
+    "score",
+)
+
+
+def _build_content(row: Dict[str, str], price_key: Optional[str]) -> str:
+    parts: List[str] = []
+    for key, label in CONTENT_FIELDS:
+        col = price_key if key is None else key
+        if col is None:
+            continue
+        value = (row.get(col) or "").strip()
+        if value:
+            parts.append(f"{label} {value}")
     return ", ".join(parts)
 
 
 def _row_metadata(row: Dict[str, str]) -> Dict[str, Any]:
-    meta_keys = [
-        "id",
-        "unidade",
-        "tipologia",
-        "bloco",
-        "piso",
-        "AHB",
-        "ABE",
-        "luz_natural",
-        "score",
-    ]
     meta: Dict[str, Any] = {}
-    for k in meta_keys:
+    for k in META_KEYS:
         if k in row and row[k] not in (None, ""):
             meta[k] = row[k]
     return meta
 
 
-def ingest(csv_path: Path = CSV_PATH, batch: int = 64) -> None:
+async def ingest(
+    csv_path: Path = CSV_PATH,
+    embed_batch_size: int = MAX_EMBED_ROWS,
+    embed_batch_tokens: int = MAX_EMBED_TOKENS,
+    upsert_batch_size: int = UPSERT_BATCH,
+    embed_workers: int = 5,
+    upsert_workers: int = 3,
+    queue_size: int = 16,
+    cache_path: Optional[Path] = CACHE_PATH,
+    use_batch_api: bool = False,
+    gzip_upserts: bool = False,
+) -> None:
+    """Embed every CSV row and upsert it into ``units_embeddings``.
+
+    Runs as a pipeline of Load -> Transform -> Embed -> Upsert stages connected by
+    bounded queues, so OpenAI and Supabase round trips overlap and memory stays
+    bounded by the queue sizes. Embedding and upsert batch sizes are independent;
+    embedding batches are packed up to ``embed_batch_tokens`` tokens or
+    ``embed_batch_size`` rows, whichever comes first.
+
+    Embeddings are cached on disk in ``cache_path`` (SQLite) by content hash, so
+    re-runs only call OpenAI for rows whose content changed. Pass ``None`` to
+    disable the cache.
+
+    With ``use_batch_api`` the Embed stage collects every uncached row and embeds
+    them through OpenAI Batch API jobs instead of synchronous requests: cheaper and
+    outside the regular rate limits, but results may take up to 24h to arrive.
+
+    ``gzip_upserts`` sends upsert bodies gzip-compressed (``Content-Encoding: gzip``);
+    leave it off unless the Supabase endpoint is known to accept compressed bodies.
+    """
     _ensure_env_loaded()
     if not csv_path.exists():
         raise FileNotFoundError(csv_path)
@@ -123,73 +261,182 @@ def ingest(csv_path: Path = CSV_PATH, batch: int = 64) -> None:
     rest_table_url = f"{url}/rest/v1/units_embeddings"
 
     client = _openai()
+    enc = _tokenizer()
+    headers = {**_sb_headers(), "Prefer": "resolution=merge-duplicates"}
+    upsert_headers = {"Content-Encoding": "gzip"} if gzip_upserts else None
+    cache = _open_cache(cache_path) if cache_path is not None else None
 
+    # Resolve the price column once per CSV rather than once per row
     with csv_path.open("r", encoding="utf-8", newline="") as f:
-        reader = csv.DictReader(f)
-        rows = list(reader)
-
-    def embed_batch(texts: List[str]) -> List[List[float]]:
-        if not texts:
-            return []
-        res = client.embeddings.create(model=EMBED_MODEL, input=texts)
-        # Keep order aligned
-        return [d.embedding for d in res.data]
-
-    payload_batch: List[Dict[str, Any]] = []
-    texts: List[str] = []
-    row_ids: List[int] = []
-
-    def flush() -> None:
-        if not payload_batch:
-            return
-        resp = requests.post(
-            rest_table_url,
-            headers={**_sb_headers(), "Prefer": "resolution=merge-duplicates"},
-            data=json.dumps(payload_batch),
-            timeout=60,
-        )
-        resp.raise_for_status()
-        payload_batch.clear()
-
-    for row in rows:
-        try:
-            rid = int((row.get("id") or "").strip() or 0)
-        except Exception:
-            # Skip rows without an id
-            continue
-        content = _build_content(row)
-        texts.append(content)
-        row_ids.append(rid)
-
-        if len(texts) >= batch:
-            embs = embed_batch(texts)
-            for rid_i, content_i, emb in zip(row_ids, texts, embs):
-                payload_batch.append(
+        price_key = find_price_key(next(csv.reader(f), []))
+
+    # A Batch API job is submitted by a single embedder
+    n_embedders = 1 if use_batch_api else embed_workers
+
+    rows_q: asyncio.Queue[Any] = asyncio.Queue(maxsize=queue_size)
+    embed_q: asyncio.Queue[Any] = asyncio.Queue(maxsize=queue_size)
+    upsert_q: asyncio.Queue[Any] = asyncio.Queue(maxsize=queue_size)
+
+    async def load() -> None:
+        with csv_path.open("r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                await rows_q.put(row)
+        await rows_q.put(_DONE)
+
+    async def transform() -> None:
+        # Pure-Python work on the loop thread, so a single transformer keeps up
+        batch: List[Tuple[int, str, Dict[str, Any]]] = []
+        batch_tokens = 0
+        while (row := await rows_q.get()) is not _DONE:
+            try:
+                rid = int((row.get("id") or "").strip() or 0)
+            except Exception:
+                # Skip rows without an id
+                continue
+            content = _build_content(row, price_key)
+            n_tokens = len(enc.encode_ordinary(content))
+            # Greedy packing: start a new batch when this row would overflow a limit
+            if batch and (
+                len(batch) >= embed_batch_size or batch_tokens + n_tokens > embed_batch_tokens
+            ):
+                await embed_q.put(batch)
+                batch = []
+                batch_tokens = 0
+            # Build metadata in the same pass as content; the raw row isn't carried on
+            batch.append((rid, content, _row_metadata(row)))
+            batch_tokens += n_tokens
+        if batch:
+            await embed_q.put(batch)
+        for _ in range(n_embedders):
+            await embed_q.put(_DONE)
+
+    async def embed() -> None:
+        while (batch := await embed_q.get()) is not _DONE:
+            texts = [content for _, content, _ in batch]
+            keys = [_cache_key(t) for t in texts]
+            vectors = _cache_get(cache, keys) if cache is not None else {}
+            misses = [i for i, key in enumerate(keys) if key not in vectors]
+            if misses:
+                res = await client.embeddings.create(
+                    model=EMBED_MODEL, input=[texts[i] for i in misses]
+                )
+                # Keep order aligned; one (B, dim) float32 matrix per batch
+                embs = np.asarray([d.embedding for d in res.data], dtype=np.float32)
+                fresh = [(keys[i], emb) for i, emb in zip(misses, embs)]
+                vectors.update(fresh)
+                if cache is not None:
+                    _cache_put(cache, fresh)
+            await upsert_q.put(
+                [
                     {
-                        "row_id": rid_i,
-                        "content": content_i,
-                        "metadata": _row_metadata(rows[rid_i - 1]) if rid_i - 1 < len(rows) else {},
-                        "embedding": emb,
+                        "row_id": rid,
+                        "content": content,
+                        "metadata": meta,
+                        "embedding": vectors[key],
                     }
-                )
-            flush()
-            texts.clear()
-            row_ids.clear()
-
-    if texts:
-        embs = embed_batch(texts)
-        for rid_i, content_i, emb in zip(row_ids, texts, embs):
-            payload_batch.append(
-                {
-                    "row_id": rid_i,
-                    "content": content_i,
-                    "metadata": _row_metadata(rows[rid_i - 1]) if rid_i - 1 < len(rows) else {},
-                    "embedding": emb,
-                }
+                    for (rid, content, meta), key in zip(batch, keys)
+                ]
+            )
+
+    async def embed_with_batch_api() -> None:
+        # The job needs every input up front, so drain the whole stream first
+        items: List[Tuple[int, str, Dict[str, Any]]] = []
+        while (batch := await embed_q.get()) is not _DONE:
+            items.extend(batch)
+        keys = [_cache_key(content) for _, content, _ in items]
+        vectors = _cache_get(cache, keys) if cache is not None else {}
+        # Identical contents share a key, so each distinct text is embedded once
+        pending = {key: content for key, (_, content, _) in zip(keys, items) if key not in vectors}
+        todo = list(pending.items())
+        for start in range(0, len(todo), BATCH_MAX_REQUESTS):
+            fresh = await _run_embedding_batch(
+                client, dict(todo[start : start + BATCH_MAX_REQUESTS])
+            )
+            vectors.update(fresh)
+            if cache is not None:
+                _cache_put(cache, fresh.items())
+        for start in range(0, len(items), upsert_batch_size):
+            await upsert_q.put(
+                [
+                    {
+                        "row_id": rid,
+                        "content": content,
+                        "metadata": meta,
+                        "embedding": vectors[key],
+                    }
+                    for (rid, content, meta), key in zip(
+                        items[start : start + upsert_batch_size],
+                        keys[start : start + upsert_batch_size],
+                    )
+                ]
             )
-        flush()
 
+    async def upsert(http: httpx.AsyncClient) -> None:
+        payload_batch: List[Dict[str, Any]] = []
+
+        async def flush(records: List[Dict[str, Any]]) -> None:
+            # A full batch is ~15 MB of JSON; encode it off the loop thread so the
+            # embed workers keep running meanwhile
+            body = await asyncio.to_thread(_encode_upsert, records, gzip_upserts)
+            for attempt in range(UPSERT_RETRIES + 1):
+                resp = await http.post(rest_table_url, content=body, headers=upsert_headers)
+                if resp.status_code not in UPSERT_RETRY_STATUSES or attempt == UPSERT_RETRIES:
+                    break
+                # Same policy as retriever._session(): backoff 0.5s, 1s, 2s, honouring
+                # Retry-After; merge-duplicates makes re-sending a batch safe
+                delay = UPSERT_BACKOFF * 2**attempt
+                retry_after = resp.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+                await asyncio.sleep(delay)
+            resp.raise_for_status()
+
+        while (records := await upsert_q.get()) is not _DONE:
+            payload_batch.extend(records)
+            # Embed batches can hold more rows than an upsert; post exact-size slices
+            while len(payload_batch) >= upsert_batch_size:
+                chunk = payload_batch[:upsert_batch_size]
+                del payload_batch[:upsert_batch_size]
+                await flush(chunk)
+        if payload_batch:
+            await flush(payload_batch)
+
+    async def close_upserts(embedders: List[asyncio.Task[None]]) -> None:
+        await asyncio.wait(embedders)
+        for _ in range(upsert_workers):
+            await upsert_q.put(_DONE)
+
+    # Keep-alive pool shared by the upsert workers; connection failures are retried
+    transport = httpx.AsyncHTTPTransport(http2=True, retries=3)
+    try:
+        async with httpx.AsyncClient(transport=transport, headers=headers, timeout=60) as http:
+            # A failure in any stage cancels the others
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(load())
+                tg.create_task(transform())
+                if use_batch_api:
+                    embedders = [tg.create_task(embed_with_batch_api())]
+                else:
+                    embedders = [tg.create_task(embed()) for _ in range(embed_workers)]
+                for _ in range(upsert_workers):
+                    tg.create_task(upsert(http))
+                tg.create_task(close_upserts(embedders))
+    finally:
+        if cache is not None:
+            cache.close()
 
-if __name__ == "__main__":
-    ingest()
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed units_rows.csv into Supabase")
+    parser.add_argument(
+        "--batch-api",
+        action="store_true",
+        help="embed through the OpenAI Batch API (cheaper, completes within 24h)",
+    )
+    parser.add_argument(
+        "--gzip-upserts",
+        action="store_true",
+        help="gzip-compress upsert request bodies (the endpoint must accept them)",
+    )
+    args = parser.parse_args()
+    asyncio.run(ingest(use_batch_api=args.batch_api, gzip_upserts=args.gzip_upserts))
@@ -1,10 +1,17 @@
 from __future__ import annotations
 
+import asyncio
+import functools
 import os
-import json
-from typing import Any, Dict, List
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     from dotenv import load_dotenv  # type: ignore
@@ -21,27 +28,110 @@ except ImportError as exc:  # pragma: no cover
 
 EMBED_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
 
+# Semantic cache: reuse RPC results for near-duplicate (paraphrased) queries
+SEMANTIC_CACHE_SIZE = 512
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_TTL = 600.0  # seconds
+
+
+_ENV_LOADED = False
+
 
 def _ensure_env_loaded() -> None:
+    # .env is parsed once per process rather than on every query
+    global _ENV_LOADED
+    if _ENV_LOADED:
+        return
     if load_dotenv is not None:
         # Do not override existing env vars
         load_dotenv(override=False)
+    _ENV_LOADED = True
 
 
+@functools.cache
 def _openai_client() -> OpenAI:
     return OpenAI()
 
 
-def embed_text(text: str) -> List[float]:
+@functools.lru_cache(maxsize=1024)
+def _embed_text_cached(text: str) -> Tuple[float, ...]:
     client = _openai_client()
     # Handle both Responses API and embeddings API depending on SDK version
     if hasattr(client, "embeddings"):
         emb = client.embeddings.create(model=EMBED_MODEL, input=text)
-        return emb.data[0].embedding  # type: ignore[no-any-return]
+        # Tuples keep cached entries immutable
+        return tuple(emb.data[0].embedding)
     # Fallback should not be needed for SDK >=1.0.0
     raise RuntimeError("OpenAI client missing embeddings.create; upgrade openai>=1.0.0")
 
 
+def embed_text(text: str, use_cache: bool = True) -> List[float]:
+    """Embed ``text``, reusing embeddings of repeated queries within the process.
+
+    Cached queries are normalized (stripped, lower-cased) so trivially different
+    spellings share one cache entry; with ``use_cache=False`` the text is embedded
+    exactly as given.
+    """
+    if not use_cache:
+        return list(_embed_text_cached.__wrapped__(text))
+    return list(_embed_text_cached(text.strip().lower()))
+
+
+class _SemanticCache:
+    """Ring buffer of recent query embeddings and the matches returned for them.
+
+    A lookup is a single matrix-vector product against the stored (L2-normalized)
+    vectors; entries older than ``ttl`` seconds or stored for different RPC
+    parameters never match.
+    """
+
+    def __init__(self, size: int, threshold: float, ttl: float) -> None:
+        self.size = size
+        self.threshold = threshold
+        self.ttl = ttl
+        self._vecs: Optional[np.ndarray] = None  # (size, dim) float32, allocated lazily
+        self._stamps = np.full(size, -np.inf)  # insert times; -inf marks an empty slot
+        self._entries: List[Optional[Tuple[Tuple[int, float], List[Dict[str, Any]]]]] = [
+            None
+        ] * size
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def get(self, q: np.ndarray, params: Tuple[int, float]) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            if self._vecs is None:
+                return None
+            usable = self._stamps >= time.monotonic() - self.ttl
+            usable &= np.fromiter(
+                (e is not None and e[0] == params for e in self._entries), bool, self.size
+            )
+            if not usable.any():
+                return None
+            sims = np.where(usable, self._vecs @ q, -1.0)
+            i = int(sims.argmax())
+            if sims[i] < self.threshold:
+                return None
+            return self._entries[i][1]  # type: ignore[index]
+
+    def put(
+        self, q: np.ndarray, params: Tuple[int, float], matches: List[Dict[str, Any]]
+    ) -> None:
+        with self._lock:
+            if self._vecs is None or self._vecs.shape[1] != q.shape[0]:
+                self._vecs = np.zeros((self.size, q.shape[0]), dtype=np.float32)
+                self._stamps[:] = -np.inf
+                self._entries = [None] * self.size
+            i = self._next
+            self._vecs[i] = q
+            self._stamps[i] = time.monotonic()
+            self._entries[i] = (params, matches)
+            self._next = (i + 1) % self.size
+
+
+_semantic_cache = _SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL)
+
+
+@functools.cache
 def _sb_headers() -> Dict[str, str]:
     url = os.getenv("SUPABASE_URL") or ""
     key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_ANON_KEY") or ""
@@ -55,17 +145,74 @@ def _sb_headers() -> Dict[str, str]:
     }
 
 
-def retrieve_context(query: str, k: int = 8, min_similarity: float = 0.0) -> List[Dict[str, Any]]:
+_SESSION: Optional[requests.Session] = None
+# Lookups run in to_thread workers; without the lock each could build its own pool
+_SESSION_LOCK = threading.Lock()
+
+
+def _session() -> requests.Session:
+    """Return the pooled Supabase session, creating it (and its headers) on first use."""
+    global _SESSION
+    session = _SESSION
+    if session is not None:
+        return session
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            return _SESSION
+        session = requests.Session()
+        retry = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 502, 503],
+            # match_units is a read-only RPC, so retrying its POST is safe
+            allowed_methods=frozenset({"POST"}),
+        )
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retry)
+        session.mount("https://", adapter)
+        session.headers.update(_sb_headers())
+        _SESSION = session
+        return session
+
+
+def invalidate_caches() -> None:
+    """Forget the env, clients and headers resolved so far (e.g. after rotating keys).
+
+    The next query re-reads the environment and builds fresh clients.
+    """
+    global _ENV_LOADED, _SESSION
+    _ENV_LOADED = False
+    _openai_client.cache_clear()
+    _sb_headers.cache_clear()
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+            _SESSION = None
+
+
+def retrieve_context(
+    query: str, k: int = 8, min_similarity: float = 0.0, use_cache: bool = True
+) -> List[Dict[str, Any]]:
     """Return top-k semantic matches from Supabase via the match_units RPC.
 
     Expects the SQL in supabase/schema_rag.sql to be applied in the project.
+    Pass ``use_cache=False`` to skip any query cache lookup/write (e.g. for long
+    conversations, where cached matches are more likely to be stale or wrong).
     """
     _ensure_env_loaded()
     url = (os.getenv("SUPABASE_URL") or "").rstrip("/")
     if not url:
         return []
 
-    query_embedding = embed_text(query)
+    query_embedding = embed_text(query, use_cache=use_cache)
+    q = np.asarray(query_embedding, dtype=np.float32)
+    q /= np.linalg.norm(q) or 1.0
+    params = (int(k), float(min_similarity))
+    if use_cache:
+        cached = _semantic_cache.get(q, params)
+        if cached is not None:
+            # Copies, like embed_text, so callers cannot mutate the cached entry
+            return list(cached)
+
     rpc_url = f"{url}/rest/v1/rpc/match_units"
     payload = {
         "query_embedding": query_embedding,
@@ -73,16 +220,51 @@ def retrieve_context(query: str, k: int = 8, min_similarity: float = 0.0) -> Lis
         "min_similarity": float(min_similarity),
     }
     try:
-        resp = requests.post(rpc_url, headers=_sb_headers(), data=json.dumps(payload), timeout=30)
+        # orjson encodes the 1536-float embedding in C; stdlib json reprs each float
+        resp = _session().post(rpc_url, data=orjson.dumps(payload), timeout=30)
         resp.raise_for_status()
         data = resp.json()
         if not isinstance(data, list):
             return []
+        if use_cache and data:
+            _semantic_cache.put(q, params, list(data))
         return data  # list of {row_id, content, metadata, similarity}
     except Exception:
         return []
 
 
+async def aretrieve_context(
+    query: str, k: int = 8, min_similarity: float = 0.0, use_cache: bool = True
+) -> List[Dict[str, Any]]:
+    """Async variant of :func:`retrieve_context` for callers running an event loop.
+
+    The lookup runs on a worker thread so it can overlap with other coroutines.
+    """
+    return await asyncio.to_thread(retrieve_context, query, k, min_similarity, use_cache)
+
+
+async def aretrieve_contexts(
+    queries: Iterable[str],
+    k: int = 8,
+    min_similarity: float = 0.0,
+    concurrency: int = 4,
+    use_cache: bool = True,
+) -> List[List[Dict[str, Any]]]:
+    """Retrieve matches for several independent queries concurrently.
+
+    At most ``concurrency`` lookups are in flight at once; results follow the
+    order of ``queries``. ``use_cache`` applies to every lookup, as in
+    :func:`retrieve_context`.
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def bounded(q: str) -> List[Dict[str, Any]]:
+        async with sem:
+            return await aretrieve_context(q, k, min_similarity, use_cache)
+
+    return list(await asyncio.gather(*(bounded(q) for q in queries)))
+
+
 def format_context_for_prompt(matches: List[Dict[str, Any]]) -> str:
     if not matches:
         return ""
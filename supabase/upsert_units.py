@@ -1,27 +1,91 @@
+import codecs
 import csv
 import datetime as dt
 import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
 from pathlib import Path
 
+try:
+    from ._csv_util import find_price_key
+except ImportError:  # run as a script from supabase/
+    from _csv_util import find_price_key
+
 # Paths
 BASE_DIR = Path(__file__).resolve().parent
 TABLET_CSV = BASE_DIR / "tablet.csv"
 UNITS_ROWS_CSV = BASE_DIR / "units_rows.csv"
-
-
-def read_csv_rows(path: Path):
-    # Try UTF-8 first, fallback to latin-1 due to special chars in the sheet
+# 1 MiB file buffers for reading the sheet and writing units_rows.csv
+READ_BUFFER = 1 << 20
+WRITE_BUFFER = 1 << 20
+
+PRICE_RE = re.compile(r"^\d{1,3}(?:,\d{3})+(?:\.\d+)?$")  # e.g., 300,104 or 1,234,567.89
+NUMBER_RE = re.compile(r"[-+]?(?:\d+(?:[.,]\d*)?|[.,]\d+)")  # e.g., 52,3 or 7 or -0.5
+# Sheets shorter than this many rows parse in-process: starting a worker pool
+# costs far more than parsing a typical few-hundred-row sheet
+PARALLEL_MIN_ROWS = 5000
+# Scoring matrix row label prefix -> unit field it fills
+MATRIX_FIELDS = (("luz natural", "luz_natural"), ("piso", "piso"), ("pontua", "score"))
+
+
+def _detect_encoding(path: Path) -> str:
+    # Try UTF-8 first, fallback to latin-1 due to special chars in the sheet.
+    # Decoding is incremental so the file is never held in memory at once.
     for enc in ("utf-8-sig", "utf-8", "latin-1"):
+        decoder = codecs.getincrementaldecoder(enc)()
         try:
-            with path.open("r", encoding=enc, newline="") as f:
-                reader = csv.reader(f)
-                return list(reader)
+            with path.open("rb") as f:
+                while chunk := f.read(READ_BUFFER):
+                    decoder.decode(chunk)
+                decoder.decode(b"", final=True)
+            return enc
         except UnicodeDecodeError:
             continue
     raise RuntimeError(f"Unable to decode CSV at {path}")
 
 
-def parse_units_from_tablet(rows):
+def read_csv_rows(path: Path):
+    """Yield CSV rows one at a time instead of materializing the whole sheet."""
+    enc = _detect_encoding(path)
+    with path.open("r", encoding=enc, newline="", buffering=READ_BUFFER) as f:
+        yield from csv.reader(f)
+
+
+def _parse_bloco_num(first: str):
+    try:
+        return int(first.split()[1].strip(":"))
+    except Exception:
+        return first.split()[1] if len(first.split()) > 1 else first
+
+
+def _to_float(val):
+    # Most cells in the sheet are text; rejecting them with a precompiled regex is
+    # much cheaper than letting float() raise for each one.
+    sval = str(val).strip() if val else ""
+    if not NUMBER_RE.fullmatch(sval):
+        return None
+    return float(sval.replace(",", "."))
+
+
+def _split_blocks(rows):
+    """Group rows into per-bloco lists, each a run of sections in sheet order.
+
+    Every 'Bloco X' row starts a section and nothing carries over between
+    sections, so each bloco can be parsed independently of the others. Rows
+    before the first section are never part of one and are dropped.
+    """
+    blocks = {}
+    current = None
+    for r in rows:
+        col0 = (r[0] or "").strip() if r else ""
+        if col0.startswith("Bloco "):
+            current = blocks.setdefault(_parse_bloco_num(col0), [])
+        if current is not None:
+            current.append(r)
+    return list(blocks.values())
+
+
+def parse_units_from_tablet(rows, max_workers=None):
     """
     Parse the multi-section spreadsheet export into a structured dict.
 
@@ -30,157 +94,125 @@ def parse_units_from_tablet(rows):
       1) Listing of units starting with a row whose col0 is 'Bloco X' and col1 like 'A t1'.
       2) A scoring matrix starting with 'Bloco X,,A,B,C,...' followed by rows 'Luz Natural', 'Piso', 'Pontua...'.
     If multiple repeated sections exist, the last occurrence wins.
-    """
-    units = {}  # (bloco)-> { unidade_letter -> data }
 
-    # Helper regexes
-    price_re = re.compile(r"^\d{1,3}(?:,\d{3})+(?:\.\d+)?$")  # e.g., 300,104 or 1,234,567.89
+    ``rows`` may be any iterable (e.g. the generator from read_csv_rows). At most
+    PARALLEL_MIN_ROWS rows are read ahead to pick a path: shorter sheets are parsed
+    in-process in one pass, so memory stays bounded by that read-ahead. Larger
+    sheets are grouped by bloco (held in memory) and the blocos are parsed in a
+    process pool of ``max_workers`` processes.
+    """
+    rows = iter(rows)
+    head = list(islice(rows, PARALLEL_MIN_ROWS))
+    if len(head) < PARALLEL_MIN_ROWS:
+        return _parse_block(chain(head, rows))
+
+    blocks = _split_blocks(chain(head, rows))
+    if len(blocks) < 2:
+        return _parse_block(chain.from_iterable(blocks))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_parse_block, blocks))
+
+    units = {}
+    for block_units in results:
+        units.update(block_units)
+    return units
 
-    i = 0
-    n = len(rows)
-    while i < n:
-        row = rows[i]
-        if not row:
-            i += 1
-            continue
 
-        first = (row[0] or "").strip() if len(row) > 0 else ""
-        if first.startswith("Bloco ") and len(row) > 1 and (row[1] or "").strip():
-            # Possible start of a unit listing section for this bloco
-            try:
-                bloco_num = int(first.split()[1].strip(":"))
-            except Exception:
-                bloco_num = (first.split()[1] if len(first.split()) > 1 else first)
+def _parse_block(rows):
+    """Parse one bloco's rows (see parse_units_from_tablet) in a single pass."""
+    units = {}  # (bloco)-> { unidade_letter -> data }
 
-            units.setdefault(bloco_num, {})
+    section = None  # None, "listing" or "matrix"
+    bloco_num = None
+    unit_cols = []  # list of (col_index, unidade_letter) for the current matrix
 
-            # Consume this and following rows that have same section (col0 empty) but carry unit data
-            j = i
-            while j < n:
-                r = rows[j]
-                if not r:
-                    j += 1
-                    continue
-                col0 = (r[0] or "").strip() if len(r) > 0 else ""
-                # Stop when next bloco header appears for a new section like 'Bloco 1,,A,B,...' (matrix)
-                # or when another section starts again with 'Optimiza' etc.
-                if col0.startswith("Optimiza"):
-                    break
-                if col0.startswith("Bloco ") and j != i:
-                    # Next bloco section (either unit list or matrix); stop current list
-                    break
-
-                # Expect unit lines when column 1 has something like 'A t1'
-                if (len(r) >= 2) and (r[1] or "").strip():
-                    unit_field = r[1].strip()
-                    # unit_field examples: 'A t1', 'H t3 D'
-                    parts = unit_field.split()
-                    unidade = parts[0].strip(",;")
-                    tipologia = " ".join(parts[1:]) if len(parts) > 1 else ""
-                    tipologia = tipologia.upper().replace("T", "T", 1)  # normalize leading t->T
-                    if tipologia and not tipologia.startswith("T"):
-                        tipologia = tipologia  # keep as-is if unusual format
-
-                    # Extract AHB and ABE values if present
-                    ahb = None
-                    abe = None
-                    # From observed layout: indices 4 and 5
-                    if len(r) > 5:
-                        try:
-                            ahb = float(str(r[4]).replace(",", "."))
-                        except Exception:
-                            ahb = None
-                        try:
-                            abe = float(str(r[5]).replace(",", "."))
-                        except Exception:
-                            abe = None
-
-                    # Extract price: prefer last price-like token before a percent field
-                    preco = None
-                    for val in r:
-                        sval = (val or "").strip().strip("\"")
-                        if sval.endswith("%"):
-                            # Stop tracking when percentages start; typically area % column follows price
-                            continue
-                        if price_re.match(sval):
-                            preco = sval
-                    # Fallback: try to find a large integer or decimal with comma separators
-                    if preco is None:
-                        for val in r[::-1]:
-                            sval = (val or "").strip().strip("\"")
-                            if price_re.match(sval):
-                                preco = sval
-                                break
-
-                    # Temporary store; scoring will fill luz_natural and score later
-                    units[bloco_num][unidade] = {
-                        "tipologia": tipologia.strip(),
-                        "AHB": ahb,
-                        "ABE": abe,
-                        "preco": preco,
-                        # placeholders
-                        "piso": None,
-                        "luz_natural": None,
-                        "score": None,
-                    }
-
-                j += 1
-
-            i = j
+    for r in rows:
+        if not r:
             continue
 
-        # Scoring matrix: 'Bloco X,,A,B,C,...' then feature rows
-        if first.startswith("Bloco ") and len(row) > 2 and not (row[1] or "").strip():
-            try:
-                bloco_num = int(first.split()[1].strip(":"))
-            except Exception:
-                bloco_num = (first.split()[1] if len(first.split()) > 1 else first)
-
-            # Determine column mapping for units
-            headers = row
-            unit_cols = []  # list of (col_index, unidade_letter)
-            for idx in range(2, len(headers)):
-                u = (headers[idx] or "").strip()
-                if u:
-                    unit_cols.append((idx, u))
-
-            j = i + 1
-            while j < n:
-                r = rows[j]
-                if not r:
-                    j += 1
-                    continue
-                label = (r[1] or "").strip() if len(r) > 1 else ""
-                if (r[0] or "").startswith("Bloco "):
-                    break  # next bloco section
-                if (r[0] or "").startswith("Optimiza"):
-                    break  # header repeating
-
-                key = label.lower()
-                for col_idx, unidade in unit_cols:
-                    if len(r) <= col_idx:
-                        continue
-                    val = (r[col_idx] or "").strip()
-                    if not val:
-                        continue
-                    try:
-                        num = float(str(val).replace(",", "."))
-                    except Exception:
-                        continue
-                    # Update only if unit already known
-                    if bloco_num in units and unidade in units[bloco_num]:
-                        if key.startswith("luz natural"):
-                            units[bloco_num][unidade]["luz_natural"] = int(num)
-                        elif key.startswith("piso"):
-                            units[bloco_num][unidade]["piso"] = int(num)
-                        elif key.startswith("pontua"):
-                            units[bloco_num][unidade]["score"] = int(num)
-                j += 1
-
-            i = j
+        col0 = (r[0] or "").strip()
+        # A header row like 'Optimiza...' ends any section
+        if col0.startswith("Optimiza"):
+            section = None
             continue
 
-        i += 1
+        if col0.startswith("Bloco "):
+            bloco_num = _parse_bloco_num(col0)
+            if len(r) > 1 and (r[1] or "").strip():
+                # Start of a unit listing section; this row already carries a unit
+                section = "listing"
+                units.setdefault(bloco_num, {})
+            elif len(r) > 2:
+                # Scoring matrix: 'Bloco X,,A,B,C,...' then feature rows
+                section = "matrix"
+                unit_cols = []
+                for idx in range(2, len(r)):
+                    u = (r[idx] or "").strip()
+                    if u:
+                        unit_cols.append((idx, u))
+                continue
+            else:
+                section = None
+                continue
+
+        if section == "listing":
+            # Expect unit lines when column 1 has something like 'A t1'
+            if (len(r) >= 2) and (r[1] or "").strip():
+                unit_field = r[1].strip()
+                # unit_field examples: 'A t1', 'H t3 D'
+                parts = unit_field.split()
+                unidade = parts[0].strip(",;")
+                tipologia = " ".join(parts[1:]) if len(parts) > 1 else ""
+                tipologia = tipologia.upper().replace("T", "T", 1)  # normalize leading t->T
+                if tipologia and not tipologia.startswith("T"):
+                    tipologia = tipologia  # keep as-is if unusual format
+
+                # Extract AHB and ABE values if present
+                ahb = None
+                abe = None
+                # From observed layout: indices 4 and 5
+                if len(r) > 5:
+                    ahb = _to_float(r[4])
+                    abe = _to_float(r[5])
+
+                # Extract price: the last price-like token in the row (percent fields,
+                # e.g. the area % column that follows the price, never match)
+                preco = None
+                for val in r:
+                    sval = val.strip().strip("\"") if val else ""
+                    if sval and not sval.endswith("%") and PRICE_RE.match(sval):
+                        preco = sval
+
+                # Temporary store; scoring will fill luz_natural and score later
+                units[bloco_num][unidade] = {
+                    "tipologia": tipologia.strip(),
+                    "AHB": ahb,
+                    "ABE": abe,
+                    "preco": preco,
+                    # placeholders
+                    "piso": None,
+                    "luz_natural": None,
+                    "score": None,
+                }
+
+        elif section == "matrix":
+            label = (r[1] or "").strip() if len(r) > 1 else ""
+            key = label.lower()
+            # The row label decides the field for every column, so resolve it once
+            field = next((f for prefix, f in MATRIX_FIELDS if key.startswith(prefix)), None)
+            block = units.get(bloco_num)
+            if field is None or not block:
+                continue
+            for col_idx, unidade in unit_cols:
+                if len(r) <= col_idx:
+                    continue
+                # Update only if unit already known
+                unit = block.get(unidade)
+                if unit is None:
+                    continue
+                num = _to_float(r[col_idx])
+                if num is not None:
+                    unit[field] = int(num)
 
     return units
 
@@ -237,6 +269,13 @@ def parse_price_to_int(s):
         return ""
 
 
+def _row_order(bloco: str, unidade: str):
+    # Numeric blocos sort before any non-numeric ones, which keep lexical order
+    if bloco.isdigit():
+        return (0, int(bloco), "", unidade)
+    return (1, 0, bloco, unidade)
+
+
 def upsert_units():
     rows = read_csv_rows(TABLET_CSV)
     parsed = parse_units_from_tablet(rows)
@@ -260,22 +299,15 @@ def upsert_units():
     now = dt.datetime.now(dt.UTC).isoformat()
 
     # Resolve the actual header key used for price (handles mojibake on 'preço')
-    def norm_ascii(s: str) -> str:
-        return "".join(ch for ch in (s or "").lower() if "a" <= ch <= "z")
-
-    price_key = None
-    for h in header:
-        nh = norm_ascii(h)
-        if nh.startswith("preco") or nh.startswith("pre"):
-            price_key = h
-            break
+    price_key = find_price_key(header)
     if price_key is None:
         # Fallback to a best-effort new key name matching schema intent
         price_key = "preco"
         if price_key not in header:
             header.append(price_key)
 
-    # Build new/updated rows
+    # Build new/updated rows; new ones start as a copy of an all-empty row
+    empty_row = dict.fromkeys(header, "")
     for bloco_num, units_in_block in parsed.items():
         bloco_str = str(bloco_num)
         for unidade, data in units_in_block.items():
@@ -283,7 +315,7 @@ def upsert_units():
             row = existing.get(key)
             if row is None:
                 max_id += 1
-                row = {h: "" for h in header}
+                row = empty_row.copy()
                 row["id"] = str(max_id)
                 row["created_at"] = now
             # Update fields
@@ -302,15 +334,13 @@ def upsert_units():
 
             existing[key] = row
 
-    # Write back CSV in a stable order: by bloco then unidade
-    out_rows = list(existing.items())
-    out_rows.sort(key=lambda kv: (kv[0][0], kv[0][1]))
+    # Write back CSV in a stable order: by bloco (numerically, so 2 < 10) then unidade
+    out_rows = sorted(existing.items(), key=lambda kv: _row_order(*kv[0]))
 
-    with UNITS_ROWS_CSV.open("w", encoding="utf-8", newline="") as f:
+    with UNITS_ROWS_CSV.open("w", encoding="utf-8", newline="", buffering=WRITE_BUFFER) as f:
         writer = csv.DictWriter(f, fieldnames=header)
         writer.writeheader()
-        for _, row in out_rows:
-            writer.writerow(row)
+        writer.writerows(row for _, row in out_rows)
 
 
 if __name__ == "__main__":